@@ -1,9 +1,22 @@
+import sqlite3
 import tempfile
+import time
 import unittest
-from datetime import datetime, timezone
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-from userbot import LeadAnalyzer, LeadStorage, load_config, resolve_notification_target, validate_runtime_config
+from userbot import (
+    REASON_BITS,
+    LeadAnalyzer,
+    LeadDecision,
+    LeadStorage,
+    build_notification,
+    load_config,
+    normalize_text,
+    resolve_notification_target,
+    validate_runtime_config,
+)
 
 
 class CoreTests(unittest.TestCase):
@@ -23,6 +36,91 @@ class CoreTests(unittest.TestCase):
         decision = analyzer.analyze("Добрый день, обсуждаем новости рынка")
         self.assertFalse(decision.is_lead)
 
+    def test_analyzer_fallback_matches_automaton(self):
+        config = {
+            "keywords": {
+                "buy": ["куплю", "куплю квартиру", "квартиру"],
+                "sell": ["продам квартиру", "квартиру"],
+                "urgency_interest": ["срочно", "срочно продам"],
+                "realtor_help": ["риелтор", "нужен риелтор"],
+                "details": ["бюджет", "район", "м²", "этаж"],
+            },
+            "rules": {},
+        }
+        messages = [
+            "Куплю квартиру срочно, бюджет 12 000 000 рублей, район Приморский",
+            "срочно продам квартиру, 45 м², 3 этаж, звоните +79991234567",
+            "нужен риелтор, куплю квартиру или продам квартиру в районе метро",
+            "квартиру квартиру квартиру, пишите test@example.com",
+            "Добрый день, обсуждаем новости рынка",
+        ]
+        with_automaton = LeadAnalyzer(config)
+        with mock.patch("userbot.ahocorasick", None):
+            without_automaton = LeadAnalyzer(config)
+
+        for text in messages:
+            with self.subTest(text=text):
+                self.assertEqual(with_automaton.analyze(text), without_automaton.analyze(text))
+
+    def test_analyzer_cache_is_per_instance_and_isolated_from_callers(self):
+        first = LeadAnalyzer(self.config)
+        second = LeadAnalyzer(self.config)
+        text = "Куплю квартиру срочно, бюджет 12 000 000 рублей"
+
+        decision = first.analyze(text)
+        expected = list(decision.reasons)
+        decision.reasons.append("tampered")
+
+        self.assertEqual(first.analyze(text).reasons, expected)
+        self.assertEqual(first._analyze_cached.cache_info().hits, 1)
+        self.assertEqual(second._analyze_cached.cache_info().currsize, 0)
+
+        first.analyze(text + " " + "x" * first.ANALYZE_CACHE_MAX_TEXT_LENGTH)
+        self.assertEqual(first._analyze_cached.cache_info().currsize, 1)
+
+    def test_analyzer_short_circuits_short_messages(self):
+        analyzer = LeadAnalyzer(self.config)
+        decision = analyzer.analyze("  ок, +1 ")
+        self.assertFalse(decision.is_lead)
+        self.assertEqual(decision.reasons, ["too_short"])
+        # Known trade-off: this would be a lead without the cutoff.
+        self.assertEqual(analyzer.analyze("ищу дом ₽").reasons, ["too_short"])
+
+    def test_decision_encodes_reasons_as_bitmask(self):
+        analyzer = LeadAnalyzer(self.config)
+        decision = analyzer.analyze("Добрый день, обсуждаем новости рынка")
+        self.assertEqual(decision.reasons, ["no_intent"])
+        self.assertEqual(decision.reasons_mask, REASON_BITS["no_intent"])
+
+    def test_normalize_text_reuses_already_normalized_input(self):
+        text = "куплю квартиру"
+        self.assertIs(normalize_text(text), text)
+        self.assertEqual(normalize_text("  Куплю КВАРТИРУ \n"), "куплю квартиру")
+
+    def test_notification_entity_offsets_use_utf16_units(self):
+        event = SimpleNamespace(sender_id=200, chat=SimpleNamespace(title="Чат 🏠"), raw_text="куплю 🏠 квартиру")
+        text, spans = build_notification(event, LeadDecision(True, ["buy_keywords:1"], "buy"), int(time.time()))
+
+        encoded = text.encode("utf-16-le")
+        rendered = [
+            (kind, encoded[2 * offset : 2 * (offset + length)].decode("utf-16-le")) for kind, offset, length in spans
+        ]
+        self.assertEqual(
+            rendered,
+            [("bold", "Новый лид найден"), ("code", "buy"), ("code", "200"), ("pre", "куплю 🏠 квартиру")],
+        )
+
+    def test_notification_does_not_end_in_whitespace(self):
+        raw_text = "куплю квартиру" + " " * 700
+        event = SimpleNamespace(sender_id=200, chat=SimpleNamespace(title="Чат"), raw_text=raw_text)
+        self.assertTrue(raw_text[:700].endswith(" "))
+
+        text, spans = build_notification(event, LeadDecision(True, ["buy_keywords:1"], "buy"), int(time.time()))
+
+        self.assertEqual(text, text.rstrip())
+        kind, offset, length = spans[-1]
+        self.assertEqual(kind, "pre")
+        self.assertEqual(offset + length, len(text.encode("utf-16-le")) // 2)
 
     def test_runtime_config_accepts_bot_username_target(self):
         config = {"notification": {"target_bot_username": "@my_leads_bot"}, "keywords": {}, "rules": {}}
@@ -32,7 +130,7 @@ class CoreTests(unittest.TestCase):
     def test_storage_deduplicates_by_chat_and_message(self):
         with tempfile.TemporaryDirectory() as tmp:
             storage = LeadStorage(Path(tmp) / "leads.db")
-            now = datetime.now(timezone.utc)
+            now = int(time.time())
             inserted1 = storage.insert_message(
                 message_id=1,
                 chat_id=100,
@@ -41,7 +139,7 @@ class CoreTests(unittest.TestCase):
                 message_text="продам квартиру, бюджет 8 000 000 рублей",
                 category="sell",
                 status="lead",
-                reasons=["sell_keywords:1", "has_budget"],
+                reasons_mask=REASON_BITS["sell_keywords"] | REASON_BITS["has_budget"],
                 created_at=now,
             )
             inserted2 = storage.insert_message(
@@ -52,7 +150,7 @@ class CoreTests(unittest.TestCase):
                 message_text="продам квартиру, бюджет 8 000 000 рублей",
                 category="sell",
                 status="lead",
-                reasons=["sell_keywords:1", "has_budget"],
+                reasons_mask=REASON_BITS["sell_keywords"] | REASON_BITS["has_budget"],
                 created_at=now,
             )
             storage.close()
@@ -60,6 +158,216 @@ class CoreTests(unittest.TestCase):
             self.assertTrue(inserted1)
             self.assertFalse(inserted2)
 
+    def test_storage_persists_buffered_rows_on_close(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = Path(tmp) / "leads.db"
+            storage = LeadStorage(db_path)
+            for message_id in range(3):
+                storage.insert_message(
+                    message_id=message_id,
+                    chat_id=100,
+                    user_id=200,
+                    chat_title="Test",
+                    message_text="куплю квартиру",
+                    category="buy",
+                    status="not_lead",
+                    reasons_mask=REASON_BITS["buy_keywords"],
+                    created_at=int(time.time()),
+                )
+            storage.close()
+
+            storage = LeadStorage(db_path)
+            count = storage.conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+            storage.close()
+
+            self.assertEqual(count, 3)
+
+    def test_storage_flush_makes_rows_visible_before_close(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = LeadStorage(Path(tmp) / "leads.db")
+            for message_id in range(3):
+                storage.insert_message(
+                    message_id=message_id,
+                    chat_id=100,
+                    user_id=200,
+                    chat_title="Test",
+                    message_text="куплю квартиру",
+                    category="buy",
+                    status="not_lead",
+                    reasons_mask=REASON_BITS["buy_keywords"],
+                    created_at=int(time.time()),
+                )
+            storage.flush()
+            count = storage.conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+            storage.close()
+
+            self.assertEqual(count, 3)
+
+    def test_storage_refuses_inserts_without_writer_thread(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = LeadStorage(Path(tmp) / "leads.db")
+            storage._queue.put_nowait(None)
+            storage._writer.join()
+
+            with self.assertRaises(RuntimeError):
+                storage.insert_message(
+                    message_id=1,
+                    chat_id=100,
+                    user_id=200,
+                    chat_title="Test",
+                    message_text="куплю квартиру",
+                    category="buy",
+                    status="lead",
+                    reasons_mask=0,
+                    created_at=int(time.time()),
+                )
+            self.assertEqual(storage._pending_keys, set())
+            storage.close()
+
+    def test_storage_migrates_legacy_schema(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = Path(tmp) / "leads.db"
+            _create_legacy_db(db_path)
+            conn = sqlite3.connect(db_path)
+            conn.execute(
+                "INSERT INTO leads (message_id, chat_id, message_text, message_hash, category, status, created_at) "
+                "VALUES (2, 100, 'x', 'x', 'none', 'not_lead', 'not a timestamp')"
+            )
+            conn.commit()
+            conn.close()
+
+            with self.assertLogs(level="WARNING"):
+                storage = LeadStorage(db_path)
+            columns = [row[1] for row in storage.conn.execute("PRAGMA table_info(leads)")]
+            row = storage.conn.execute("SELECT reasons_mask, created_at FROM leads WHERE message_id = 1").fetchone()
+            unparsed = storage.conn.execute("SELECT created_at FROM leads WHERE message_id = 2").fetchone()
+            indexes = {row[0] for row in storage.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            duplicate = storage.insert_message(
+                message_id=1,
+                chat_id=100,
+                user_id=200,
+                chat_title="Test",
+                message_text="продам квартиру",
+                category="sell",
+                status="lead",
+                reasons_mask=0,
+                created_at=int(time.time()),
+            )
+            storage.close()
+
+            self.assertNotIn("message_hash", columns)
+            self.assertNotIn("reasons", columns)
+            self.assertIn("reasons_mask", columns)
+            self.assertEqual(row["reasons_mask"], REASON_BITS["sell_keywords"] | REASON_BITS["has_budget"])
+            self.assertEqual(row["created_at"], 1704103200)
+            self.assertEqual(unparsed["created_at"], 0)
+            self.assertIn("idx_leads_status_user", indexes)
+            self.assertNotIn("idx_leads_user_id", indexes)
+            self.assertFalse(duplicate)
+
+    def test_storage_legacy_migration_is_atomic_and_retryable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = Path(tmp) / "leads.db"
+            _create_legacy_db(db_path)
+
+            with mock.patch("userbot.encode_reasons", side_effect=RuntimeError("boom")):
+                with self.assertRaises(RuntimeError):
+                    LeadStorage(db_path)
+
+            conn = sqlite3.connect(db_path)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(leads)")]
+            conn.close()
+            self.assertIn("message_hash", columns)
+            self.assertNotIn("reasons_mask", columns)
+
+            storage = LeadStorage(db_path)
+            columns = [row[1] for row in storage.conn.execute("PRAGMA table_info(leads)")]
+            row = storage.conn.execute("SELECT reasons_mask, created_at FROM leads WHERE message_id = 1").fetchone()
+            storage.close()
+
+            self.assertEqual(
+                columns,
+                [
+                    "id",
+                    "message_id",
+                    "chat_id",
+                    "user_id",
+                    "chat_title",
+                    "message_text",
+                    "category",
+                    "status",
+                    "reasons_mask",
+                    "created_at",
+                ],
+            )
+            self.assertEqual(row["reasons_mask"], REASON_BITS["sell_keywords"] | REASON_BITS["has_budget"])
+            self.assertEqual(row["created_at"], 1704103200)
+
+    def test_storage_repairs_half_migrated_legacy_schema(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = Path(tmp) / "leads.db"
+            _create_legacy_db(db_path)
+            # State left behind by earlier releases when the migration failed after its autocommitted DDL.
+            conn = sqlite3.connect(db_path)
+            conn.execute("ALTER TABLE leads DROP COLUMN message_hash")
+            conn.execute("ALTER TABLE leads ADD COLUMN reasons_mask INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE leads ADD COLUMN created_ts INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+            conn.close()
+
+            storage = LeadStorage(db_path)
+            columns = [row[1] for row in storage.conn.execute("PRAGMA table_info(leads)")]
+            row = storage.conn.execute("SELECT reasons_mask, created_at FROM leads WHERE message_id = 1").fetchone()
+            storage.close()
+
+            self.assertNotIn("reasons", columns)
+            self.assertNotIn("created_ts", columns)
+            self.assertEqual(row["reasons_mask"], REASON_BITS["sell_keywords"] | REASON_BITS["has_budget"])
+            self.assertEqual(row["created_at"], 1704103200)
+
+
+def _create_legacy_db(db_path):
+    """Create a ``leads`` table with the original schema and one row."""
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        """
+        CREATE TABLE leads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER,
+            chat_title TEXT,
+            message_text TEXT NOT NULL,
+            message_hash TEXT NOT NULL,
+            category TEXT NOT NULL,
+            status TEXT NOT NULL,
+            reasons TEXT,
+            created_at TEXT NOT NULL,
+            UNIQUE(chat_id, message_id)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX idx_leads_status ON leads(status)")
+    conn.execute("CREATE INDEX idx_leads_user_id ON leads(user_id)")
+    conn.execute(
+        "INSERT INTO leads (message_id, chat_id, user_id, chat_title, message_text, message_hash, "
+        "category, status, reasons, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            1,
+            100,
+            200,
+            "Test",
+            "продам квартиру",
+            "0" * 64,
+            "sell",
+            "lead",
+            "sell_keywords:1,has_budget",
+            "2024-01-01T10:00:00.123456+00:00",
+        ),
+    )
+    conn.commit()
+    conn.close()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -12,18 +12,70 @@ Features:
 from __future__ import annotations
 
 import argparse
+import functools
 import json
 import logging
 import os
+import queue
 import re
 import signal
 import sqlite3
 import sys
+import threading
+import time
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from hashlib import sha256
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO, Collection
+
+try:
+    import ahocorasick
+except ModuleNotFoundError:  # pragma: no cover - falls back to plain substring scans
+    ahocorasick = None
+
+try:
+    import orjson
+except ModuleNotFoundError:  # pragma: no cover - falls back to the stdlib json module
+    orjson = None
+
+_BUDGET_TOKENS = frozenset({"бюджет", "₽", "руб", "рублей"})
+_LOCATION_TOKENS = frozenset({"район", "метро", "ул.", "улица", "город", "жк", "этаж"})
+_AREA_TOKENS = frozenset({"площадь", "м²", "кв.м"})
+
+REASON_BITS = {
+    "buy_keywords": 1 << 0,
+    "sell_keywords": 1 << 1,
+    "urgency_keywords": 1 << 2,
+    "realtor_keywords": 1 << 3,
+    "detail_keywords": 1 << 4,
+    "has_budget": 1 << 5,
+    "has_location": 1 << 6,
+    "has_area": 1 << 7,
+    "has_contact": 1 << 8,
+    "no_intent": 1 << 9,
+    "insufficient_details": 1 << 10,
+    "empty_message": 1 << 11,
+    "too_short": 1 << 12,
+}
+
+_COUNT_REASONS = ("buy_keywords", "sell_keywords", "urgency_keywords", "realtor_keywords", "detail_keywords")
+_FLAG_REASONS = ("has_budget", "has_location", "has_area", "has_contact")
+
+
+def normalize_text(text: str) -> str:
+    """Strip and lowercase ``text``, returning it unchanged if already normalized."""
+    cleaned = text.strip()
+    if cleaned.islower():
+        return cleaned
+    return cleaned.lower()
+
+
+def encode_reasons(reasons: list[str]) -> int:
+    """Pack reason labels (``"buy_keywords:2"`` style counts are ignored) into a ``REASON_BITS`` mask."""
+    mask = 0
+    for reason in reasons:
+        mask |= REASON_BITS.get(reason.partition(":")[0], 0)
+    return mask
+
 
 @dataclass(slots=True)
 class LeadDecision:
@@ -31,12 +83,26 @@ class LeadDecision:
     reasons: list[str]
     category: str
 
+    @property
+    def reasons_mask(self) -> int:
+        return encode_reasons(self.reasons)
+
 
 class LeadAnalyzer:
     """Analyzes text against configurable lead rules."""
 
     PHONE_REGEX = re.compile(r"(?:(?:\+7|7|8)[\s\-()]*)?(?:\d[\s\-()]*){10,11}")
     EMAIL_REGEX = re.compile(r"[\w.+\-]+@[\w\-]+\.[\w.\-]+", re.IGNORECASE)
+    BUDGET_REGEX = re.compile(r"\b\d{2,}\s?(?:₽|руб|рублей|р\.)")
+    AREA_REGEX = re.compile(r"\b\d{1,4}\s?(?:м²|кв\.м|м2)\b")
+
+    # Deliberate cutoff: messages shorter than this skip scanning. It drops a few very short
+    # leads such as "ищу дом ₽" (9 chars); longer messages are clamped before scanning.
+    MIN_TEXT_LENGTH = 10
+    MAX_TEXT_LENGTH = 10_000
+    # Cache keys are whole messages: 1024 entries of at most 2000 characters keep it to a few MB.
+    ANALYZE_CACHE_SIZE = 1024
+    ANALYZE_CACHE_MAX_TEXT_LENGTH = 2000
 
     def __init__(self, config: dict[str, Any]) -> None:
         keywords = config["keywords"]
@@ -55,116 +121,273 @@ class LeadAnalyzer:
         if self.min_details_required < 0:
             self.min_details_required = 0
 
+        self._keyword_groups: dict[str, Collection[str]] = {
+            "buy": self.buy_keywords,
+            "sell": self.sell_keywords,
+            "urgency": self.urgency_keywords,
+            "realtor": self.realtor_keywords,
+            "detail": self.detail_keywords,
+            "budget_token": _BUDGET_TOKENS,
+            "location_token": _LOCATION_TOKENS,
+            "area_token": _AREA_TOKENS,
+        }
+        self._automaton = self._build_automaton(self._keyword_groups)
+        # Per-instance cache: forwarded listings and reposts repeat the same text across chats.
+        self._analyze_cached = functools.lru_cache(maxsize=self.ANALYZE_CACHE_SIZE)(self._analyze_normalized)
+
     @staticmethod
     def _normalize_list(values: list[str]) -> list[str]:
         return [v.strip().lower() for v in values if isinstance(v, str) and v.strip()]
 
+    @staticmethod
+    def _build_automaton(groups: dict[str, Collection[str]]) -> Any:
+        """Build one Aho–Corasick automaton over every keyword, tagged with its groups."""
+        if ahocorasick is None:
+            return None
+
+        word_groups: dict[str, list[str]] = {}
+        for group, words in groups.items():
+            for word in words:
+                word_groups.setdefault(word, []).append(group)
+
+        automaton = ahocorasick.Automaton()
+        for word, tags in word_groups.items():
+            automaton.add_word(word, (word, tuple(tags)))
+        automaton.make_automaton()
+        return automaton
+
+    def _scan(self, cleaned: str) -> dict[str, set[str]]:
+        """Return the distinct keywords found in ``cleaned``, bucketed by group."""
+        hits: dict[str, set[str]] = {group: set() for group in self._keyword_groups}
+        if self._automaton is not None:
+            for _, (word, tags) in self._automaton.iter(cleaned):
+                for group in tags:
+                    hits[group].add(word)
+        else:
+            for group, words in self._keyword_groups.items():
+                hits[group].update(word for word in words if word in cleaned)
+        return hits
+
     def analyze(self, text: str) -> LeadDecision:
-        cleaned = (text or "").strip().lower()
+        if not text:
+            return LeadDecision(False, ["empty_message"], "none")
+        cleaned = normalize_text(text)
         if not cleaned:
             return LeadDecision(False, ["empty_message"], "none")
+        if len(cleaned) < self.MIN_TEXT_LENGTH:
+            return LeadDecision(False, ["too_short"], "none")
+        if len(cleaned) > self.MAX_TEXT_LENGTH:
+            cleaned = cleaned[: self.MAX_TEXT_LENGTH]
 
-        buy_hits = [kw for kw in self.buy_keywords if kw in cleaned]
-        sell_hits = [kw for kw in self.sell_keywords if kw in cleaned]
-        urgency_hits = [kw for kw in self.urgency_keywords if kw in cleaned]
-        realtor_hits = [kw for kw in self.realtor_keywords if kw in cleaned]
-        detail_hits = [kw for kw in self.detail_keywords if kw in cleaned]
-
-        has_budget = bool(re.search(r"\b\d{2,}\s?(?:₽|руб|рублей|р\.)", cleaned)) or any(
-            token in cleaned for token in ("бюджет", "₽", "руб", "рублей")
-        )
-        has_location = any(token in cleaned for token in ("район", "метро", "ул.", "улица", "город", "жк", "этаж"))
-        has_area = bool(re.search(r"\b\d{1,4}\s?(?:м²|кв\.м|м2)\b", cleaned)) or any(
-            token in cleaned for token in ("площадь", "м²", "кв.м")
+        if len(cleaned) <= self.ANALYZE_CACHE_MAX_TEXT_LENGTH:
+            is_lead, reasons, category = self._analyze_cached(cleaned)
+        else:
+            is_lead, reasons, category = self._analyze_normalized(cleaned)
+        return LeadDecision(is_lead, list(reasons), category)
+
+    def _analyze_normalized(self, cleaned: str) -> tuple[bool, tuple[str, ...], str]:
+        features = self._extract_features(cleaned)
+        is_lead, category, rejection = self._score(features)
+
+        reasons = self._build_reasons(features)
+        if rejection:
+            reasons.append(rejection)
+        return is_lead, tuple(reasons), category
+
+    def _extract_features(self, cleaned: str) -> tuple[int, ...]:
+        """Collapse the message into the feature vector consumed by ``_score``.
+
+        Layout: hit counts for buy/sell/urgency/realtor/detail keywords followed by
+        0/1 flags for budget, location, area and contact.
+        """
+        hits = self._scan(cleaned)
+        has_budget = bool(hits["budget_token"]) or bool(self.BUDGET_REGEX.search(cleaned))
+        has_location = bool(hits["location_token"])
+        has_area = bool(hits["area_token"]) or bool(self.AREA_REGEX.search(cleaned))
+        # An e-mail always contains "@"; the cheap membership test skips the regex walk otherwise.
+        has_contact = bool(self.PHONE_REGEX.search(cleaned) or ("@" in cleaned and self.EMAIL_REGEX.search(cleaned)))
+
+        return (
+            len(hits["buy"]),
+            len(hits["sell"]),
+            len(hits["urgency"]),
+            len(hits["realtor"]),
+            len(hits["detail"]),
+            int(has_budget),
+            int(has_location),
+            int(has_area),
+            int(has_contact),
         )
-        has_contact = bool(self.PHONE_REGEX.search(cleaned) or self.EMAIL_REGEX.search(cleaned))
 
-        details_score = sum([has_budget, has_location, has_area])
-        intent_hits = buy_hits + sell_hits
+    def _score(self, features: tuple[int, ...]) -> tuple[bool, str, str | None]:
+        """Apply the lead rules; returns ``(is_lead, category, rejection_reason)``."""
+        n_buy, n_sell, n_urgency, n_realtor, _, has_budget, has_location, has_area, has_contact = features
+        details_score = has_budget + has_location + has_area
+        has_intent = bool(n_buy or n_sell)
 
-        if buy_hits and not sell_hits:
+        if n_buy and not n_sell:
             category = "buy"
-        elif sell_hits and not buy_hits:
+        elif n_sell and not n_buy:
             category = "sell"
-        elif buy_hits and sell_hits:
+        elif n_buy and n_sell:
             category = "mixed"
-        elif realtor_hits:
+        elif n_realtor:
             category = "realtor_help"
         else:
             category = "none"
 
-        reasons: list[str] = []
-        if buy_hits:
-            reasons.append(f"buy_keywords:{len(buy_hits)}")
-        if sell_hits:
-            reasons.append(f"sell_keywords:{len(sell_hits)}")
-        if urgency_hits:
-            reasons.append(f"urgency_keywords:{len(urgency_hits)}")
-        if realtor_hits:
-            reasons.append(f"realtor_keywords:{len(realtor_hits)}")
-        if detail_hits:
-            reasons.append(f"detail_keywords:{len(detail_hits)}")
-        if has_budget:
-            reasons.append("has_budget")
-        if has_location:
-            reasons.append("has_location")
-        if has_area:
-            reasons.append("has_area")
-        if has_contact:
-            reasons.append("has_contact")
-
-        if self.require_explicit_intent and not intent_hits and not realtor_hits:
-            return LeadDecision(False, reasons + ["no_intent"], category)
+        if self.require_explicit_intent and not has_intent and not n_realtor:
+            return False, category, "no_intent"
 
         if details_score < self.min_details_required and not has_contact:
-            return LeadDecision(False, reasons + ["insufficient_details"], category)
+            return False, category, "insufficient_details"
 
-        lead_score = 0
-        if intent_hits:
+        lead_score = details_score
+        if has_intent:
             lead_score += 2
-        if details_score > 0:
-            lead_score += details_score
-        if urgency_hits:
+        if n_urgency:
             lead_score += 1
-        if realtor_hits:
+        if n_realtor:
             lead_score += 1
         if self.contact_bonus and has_contact:
             lead_score += 1
 
-        return LeadDecision(lead_score >= 3, reasons, category)
+        return lead_score >= 3, category, None
+
+    @staticmethod
+    def _build_reasons(features: tuple[int, ...]) -> list[str]:
+        reasons = [f"{label}:{count}" for label, count in zip(_COUNT_REASONS, features) if count]
+        reasons.extend(label for label, flag in zip(_FLAG_REASONS, features[len(_COUNT_REASONS):]) if flag)
+        return reasons
+
+
+_INSERT_SQL = (
+    "INSERT OR IGNORE INTO leads "
+    "(message_id, chat_id, user_id, chat_title, message_text, category, status, reasons_mask, created_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_EXISTS_SQL = "SELECT 1 FROM leads WHERE chat_id = ? AND message_id = ?"
 
 
 class LeadStorage:
-    """SQLite storage layer with duplicate protection."""
+    """SQLite storage layer with duplicate protection.
+
+    Inserts are handed to a background writer thread that commits them in batches of
+    ``FLUSH_BATCH_SIZE`` rows or at least every ``FLUSH_INTERVAL`` seconds. ``self.conn``
+    belongs to the calling thread and is only used for schema setup and duplicate lookups;
+    a second connection, opened in ``__init__``, is used only by the writer thread.
+    ``flush()`` blocks until queued rows are on disk.
+    """
+
+    FLUSH_BATCH_SIZE = 50
+    FLUSH_INTERVAL = 0.1
 
     def __init__(self, db_path: Path) -> None:
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row
+        self.conn = self._connect(db_path)
         self._init_schema()
+        # Opened here so connection errors surface to the caller; only the writer thread uses it afterwards.
+        self._writer_conn = self._connect(db_path, check_same_thread=False)
+
+        self._queue: queue.SimpleQueue[Any] = queue.SimpleQueue()
+        self._pending_keys: set[tuple[int, int]] = set()
+        self._pending_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._writer_loop, name="lead-storage-writer", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def _connect(db_path: Path, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        return conn
 
     def _init_schema(self) -> None:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS leads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id INTEGER NOT NULL,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER,
-                chat_title TEXT,
-                message_text TEXT NOT NULL,
-                message_hash TEXT NOT NULL,
-                category TEXT NOT NULL,
-                status TEXT NOT NULL,
-                reasons TEXT,
-                created_at TEXT NOT NULL,
-                UNIQUE(chat_id, message_id)
+        conn = self.conn
+        # Explicit transaction so a failed legacy migration rolls back completely, DDL included.
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leads (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    chat_title TEXT,
+                    message_text TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    reasons_mask INTEGER NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    UNIQUE(chat_id, message_id)
+                )
+                """
             )
-            """
+            self._migrate_legacy_columns(conn)
+            # One composite index serves both status and status+user lookups with a single B-tree update per insert.
+            conn.execute("DROP INDEX IF EXISTS idx_leads_status")
+            conn.execute("DROP INDEX IF EXISTS idx_leads_user_id")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_status_user ON leads(status, user_id)")
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.isolation_level = isolation_level
+
+    @staticmethod
+    def _migrate_legacy_columns(conn: sqlite3.Connection) -> None:
+        """Bring a table created by an older release up to the current schema.
+
+        Every step checks the current columns, so databases left half-migrated by earlier
+        releases (which did not run this in one transaction) are repaired as well.
+        """
+        columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(leads)")}
+        is_legacy = (
+            "message_hash" in columns
+            or "reasons" in columns
+            or "created_ts" in columns
+            or columns.get("created_at") == "TEXT"
         )
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_status ON leads(status)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_leads_user_id ON leads(user_id)")
-        self.conn.commit()
+        if is_legacy and sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError(
+                f"Upgrading the existing leads table requires SQLite >= 3.35 (found {sqlite3.sqlite_version})"
+            )
+        if "message_hash" in columns:
+            # Dedup is enforced by UNIQUE(chat_id, message_id); the content hash was never read.
+            conn.execute("ALTER TABLE leads DROP COLUMN message_hash")
+        if "reasons" in columns:
+            if "reasons_mask" not in columns:
+                conn.execute("ALTER TABLE leads ADD COLUMN reasons_mask INTEGER NOT NULL DEFAULT 0")
+            legacy = conn.execute("SELECT id, reasons FROM leads WHERE reasons IS NOT NULL").fetchall()
+            conn.executemany(
+                "UPDATE leads SET reasons_mask = ? WHERE id = ?",
+                [(encode_reasons(reasons.split(",")), row_id) for row_id, reasons in legacy],
+            )
+            conn.execute("ALTER TABLE leads DROP COLUMN reasons")
+        if columns.get("created_at") == "TEXT":
+            # ISO-8601 text timestamps become Unix epoch seconds.
+            if "created_ts" in columns:
+                conn.execute("ALTER TABLE leads DROP COLUMN created_ts")
+            conn.execute("ALTER TABLE leads ADD COLUMN created_ts INTEGER NOT NULL DEFAULT 0")
+            # Values SQLite cannot parse fall back to 0 rather than aborting startup on one bad row.
+            conn.execute("UPDATE leads SET created_ts = COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)")
+            unparsed = conn.execute("SELECT COUNT(*) FROM leads WHERE strftime('%s', created_at) IS NULL").fetchone()[0]
+            if unparsed:
+                logging.warning("Set created_at to 0 for %s legacy rows with unparsable timestamps", unparsed)
+            conn.execute("ALTER TABLE leads DROP COLUMN created_at")
+            conn.execute("ALTER TABLE leads RENAME COLUMN created_ts TO created_at")
+        elif "created_ts" in columns:
+            if "created_at" in columns:
+                conn.execute("ALTER TABLE leads DROP COLUMN created_ts")
+            else:
+                conn.execute("ALTER TABLE leads RENAME COLUMN created_ts TO created_at")
 
     def insert_message(
         self,
@@ -176,43 +399,109 @@ class LeadStorage:
         message_text: str,
         category: str,
         status: str,
-        reasons: list[str],
-        created_at: datetime,
+        reasons_mask: int,
+        created_at: int,
     ) -> bool:
-        message_hash = sha256(message_text.strip().lower().encode("utf-8")).hexdigest()
-        try:
-            self.conn.execute(
-                """
-                INSERT INTO leads (
-                    message_id, chat_id, user_id, chat_title, message_text,
-                    message_hash, category, status, reasons, created_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    message_id,
-                    chat_id,
-                    user_id,
-                    chat_title,
-                    message_text,
-                    message_hash,
-                    category,
-                    status,
-                    ",".join(reasons),
-                    created_at.isoformat(),
-                ),
+        if not self._writer.is_alive():
+            raise RuntimeError("LeadStorage writer thread is not running; message was not stored")
+
+        key = (chat_id, message_id)
+        with self._pending_lock:
+            # The writer drops keys only after committing, so a key missing here is either new or already in the table.
+            if key in self._pending_keys or self._exists(chat_id, message_id):
+                return False
+            self._pending_keys.add(key)
+
+        self._queue.put_nowait(
+            (
+                message_id,
+                chat_id,
+                user_id,
+                chat_title,
+                message_text,
+                category,
+                status,
+                reasons_mask,
+                created_at,
             )
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+        )
+        return True
+
+    def _exists(self, chat_id: int, message_id: int) -> bool:
+        row = self.conn.execute(_EXISTS_SQL, (chat_id, message_id)).fetchone()
+        return row is not None
+
+    def _writer_loop(self) -> None:
+        conn = self._writer_conn
+        try:
+            stopping = False
+            while not stopping:
+                batch: list[tuple[Any, ...]] = []
+                flushed: list[threading.Event] = []
+                item = self._queue.get()
+                deadline = time.monotonic() + self.FLUSH_INTERVAL
+                while True:
+                    if item is None:
+                        stopping = True
+                        break
+                    if isinstance(item, threading.Event):
+                        flushed.append(item)
+                        break
+                    batch.append(item)
+                    timeout = deadline - time.monotonic()
+                    if len(batch) >= self.FLUSH_BATCH_SIZE or timeout <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+
+                try:
+                    self._write_batch(conn, batch)
+                finally:
+                    for event in flushed:
+                        event.set()
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: list[tuple[Any, ...]]) -> None:
+        if not batch:
+            return
+        try:
+            conn.executemany(_INSERT_SQL, batch)
+            conn.commit()
+        except Exception:  # noqa: BLE001 - the writer must only stop on the close() sentinel
+            logging.exception("Failed to write %s messages", len(batch))
+        finally:
+            with self._pending_lock:
+                self._pending_keys.difference_update((row[1], row[0]) for row in batch)
+
+    def flush(self) -> None:
+        """Block until every row queued so far has been committed."""
+        if not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put_nowait(done)
+        done.wait()
 
     def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put_nowait(None)
+            self._writer.join()
+        else:
+            self._writer_conn.close()
         self.conn.close()
 
 
+def _json_load(fh: BinaryIO) -> Any:
+    if orjson is not None:
+        return orjson.loads(fh.read())
+    return json.load(fh)
+
+
 def load_config(path: Path) -> dict[str, Any]:
-    with path.open("r", encoding="utf-8") as fh:
-        config = json.load(fh)
+    with path.open("rb") as fh:
+        config = _json_load(fh)
 
     required_keys = {"notification", "keywords", "rules"}
     missing = required_keys - set(config.keys())
@@ -269,27 +558,48 @@ def setup_logging(verbose: bool) -> None:
     )
 
 
-def build_notification(event, decision: LeadDecision) -> str:
-    sender = event.sender_id
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def build_notification(event, decision: LeadDecision, created_at: int) -> tuple[str, list[tuple[str, int, int]]]:
+    """Render a lead notification as plain text plus ``(kind, offset, length)`` entity spans.
+
+    Offsets and lengths are in UTF-16 code units, as Telegram expects, so the message can be
+    sent with ``formatting_entities`` instead of being re-parsed as Markdown.
+    """
     chat_name = getattr(event.chat, "title", None) or "Unknown chat"
-    created = datetime.now(timezone.utc).astimezone().strftime("%Y-%m-%d %H:%M:%S %Z")
-    text = (event.raw_text or "")[:700]
-
-    return (
-        "🏠 *Новый лид найден*\n"
-        f"• Категория: `{decision.category}`\n"
-        f"• Чат: {chat_name}\n"
-        f"• User ID: `{sender}`\n"
-        f"• Время: {created}\n"
-        f"• Причины: {', '.join(decision.reasons[:8])}\n\n"
-        f"Сообщение:\n```\n{text}\n```"
+    created = time.strftime("%Y-%m-%d %H:%M:%S %Z", time.localtime(created_at))
+    reasons = ", ".join(decision.reasons[:8])
+    # Telegram trims trailing whitespace, which would leave the "pre" span pointing past the end.
+    text = (event.raw_text or "")[:700].rstrip()
+
+    parts = (
+        ("🏠 ", None),
+        ("Новый лид найден", "bold"),
+        ("\n• Категория: ", None),
+        (decision.category, "code"),
+        (f"\n• Чат: {chat_name}\n• User ID: ", None),
+        (str(event.sender_id), "code"),
+        (f"\n• Время: {created}\n• Причины: {reasons}\n\nСообщение:\n", None),
+        (text, "pre"),
     )
 
+    spans: list[tuple[str, int, int]] = []
+    offset = 0
+    for chunk, kind in parts:
+        length = _utf16_len(chunk)
+        if kind and length:
+            spans.append((kind, offset, length))
+        offset += length
+    return "".join(chunk for chunk, _ in parts), spans
+
 
 async def run_bot(args: argparse.Namespace) -> None:
     try:
         from telethon import TelegramClient, events
         from telethon.errors import FloodWaitError, RPCError
+        from telethon.tl.types import MessageEntityBold, MessageEntityCode, MessageEntityPre
     except ModuleNotFoundError as exc:
         raise RuntimeError(
             "Telethon is not installed. Install dependencies with: pip install -r requirements.txt"
@@ -304,6 +614,12 @@ async def run_bot(args: argparse.Namespace) -> None:
     api_hash = prompt_if_empty(args.api_hash or os.getenv("API_HASH"), "API_HASH")
     notify_target = resolve_notification_target(config)
 
+    entity_factories = {
+        "bold": MessageEntityBold,
+        "code": MessageEntityCode,
+        "pre": lambda offset, length: MessageEntityPre(offset, length, language=""),
+    }
+
     processed_count = 0
     lead_count = 0
 
@@ -327,35 +643,44 @@ async def run_bot(args: argparse.Namespace) -> None:
         try:
             if not (event.is_group or event.is_channel):
                 return
-            if not event.raw_text:
+            raw_text = event.raw_text
+            if not raw_text:
                 return
 
+            chat_id = event.chat_id
+            message = event.message
+            message_id = message.id
+            sender_id = event.sender_id
+            created_at = int(message.date.timestamp())
+
             processed_count += 1
-            decision = analyzer.analyze(event.raw_text)
+            decision = analyzer.analyze(raw_text)
             status = "lead" if decision.is_lead else "not_lead"
 
-            chat_title = getattr(event.chat, "title", None) or str(event.chat_id)
+            chat_title = getattr(event.chat, "title", None) or str(chat_id)
             inserted = storage.insert_message(
-                message_id=event.message.id,
-                chat_id=event.chat_id,
-                user_id=event.sender_id,
+                message_id=message_id,
+                chat_id=chat_id,
+                user_id=sender_id,
                 chat_title=chat_title,
-                message_text=event.raw_text,
+                message_text=raw_text,
                 category=decision.category,
                 status=status,
-                reasons=decision.reasons,
-                created_at=event.message.date.astimezone(timezone.utc),
+                reasons_mask=decision.reasons_mask,
+                created_at=created_at,
             )
 
             if not inserted:
-                logging.debug("Duplicate message skipped chat_id=%s message_id=%s", event.chat_id, event.message.id)
+                logging.debug("Duplicate message skipped chat_id=%s message_id=%s", chat_id, message_id)
                 return
 
             if decision.is_lead:
                 lead_count += 1
-                logging.info("Lead found in %s (chat_id=%s, user_id=%s)", chat_title, event.chat_id, event.sender_id)
+                logging.info("Lead found in %s (chat_id=%s, user_id=%s)", chat_title, chat_id, sender_id)
+                text, spans = build_notification(event, decision, created_at)
+                entities = [entity_factories[kind](offset, length) for kind, offset, length in spans]
                 try:
-                    await client.send_message(notify_target, build_notification(event, decision), parse_mode="markdown")
+                    await client.send_message(notify_target, text, formatting_entities=entities)
                 except FloodWaitError as exc:
                     logging.warning("FloodWait while sending notification: %s seconds", exc.seconds)
                 except RPCError as exc:
@@ -374,6 +699,7 @@ async def run_bot(args: argparse.Namespace) -> None:
     await client.start()
     logging.info("Userbot started. Monitoring all group/channel messages...")
     await client.run_until_disconnected()
+    await shutdown()
 
 
 def asyncio_create_task_safe(coro):